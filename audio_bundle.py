@@ -0,0 +1,133 @@
+import os
+import re
+import sys
+import json
+import mmap
+import random
+import struct
+import logging
+import numpy as np
+from audio_engine import BufferSource, SAMPLE_RATE, CHANNELS
+
+# Packed bundle of every voice's canned clips decoded once into raw PCM.
+# Playback reads a zero copy slice of the memory mapped file, no decoding or file opens.
+#
+# Build with:
+# python audio_bundle.py [audio dir] [bundle file]
+#
+# File layout: magic, index length (uint32 LE), JSON index, padding to a page boundary, PCM data.
+# The index is {"sample_rate": .., "voices": {voice: {category: [{"variant": n, "offset": .., "frames": ..}]}}}
+# with offsets in bytes from the start of the PCM data
+
+BUNDLE_MAGIC = b'SIMCLIP1'
+PAGE_SIZE = 4096
+
+# Canned clips are named <category>_<variant>.mp3, e.g. water_default_3.mp3
+clip_name_pattern = re.compile(r'^(?P<category>[a-z_]+)_(?P<variant>\d+)\.(mp3|wav)$')
+
+# Find every canned clip as {voice: {category: {variant: path}}}
+def find_canned_clips(audio_dir):
+    clips = {}
+    for voice in sorted(os.listdir(audio_dir)):
+        voice_dir = os.path.join(audio_dir, voice)
+        if not os.path.isdir(voice_dir):
+            continue
+        for file_name in sorted(os.listdir(voice_dir)):
+            match = clip_name_pattern.match(file_name)
+            if match is None:
+                continue
+            if os.path.getsize(os.path.join(voice_dir, file_name)) == 0:
+                logging.warning(f"Skipping empty clip {os.path.join(voice_dir, file_name)}")
+                continue
+            categories = clips.setdefault(voice, {})
+            categories.setdefault(match['category'], {})[int(match['variant'])] = os.path.join(voice_dir, file_name)
+    return clips
+
+# Decode all canned clips and write the bundle
+def build_bundle(audio_dir, bundle_file):
+    import miniaudio
+    index = {"sample_rate": SAMPLE_RATE, "voices": {}}
+    pcm_chunks = []
+    offset = 0
+    for voice, categories in find_canned_clips(audio_dir).items():
+        for category, variants in categories.items():
+            entries = index["voices"].setdefault(voice, {}).setdefault(category, [])
+            for variant, path in sorted(variants.items()):
+                try:
+                    decoded = miniaudio.decode_file(path,
+                                                    output_format=miniaudio.SampleFormat.SIGNED16,
+                                                    nchannels=CHANNELS,
+                                                    sample_rate=SAMPLE_RATE)
+                except miniaudio.DecodeError as e:
+                    logging.error(f"Skipping {path}, unable to decode: {e}")
+                    continue
+                pcm = decoded.samples.tobytes()
+                entries.append({"variant": variant, "offset": offset, "frames": len(pcm) // 2})
+                pcm_chunks.append(pcm)
+                offset += len(pcm)
+                logging.debug(f"Packed {path}")
+    index_bytes = json.dumps(index).encode('utf-8')
+    header_length = len(BUNDLE_MAGIC) + 4 + len(index_bytes)
+    padding = -header_length % PAGE_SIZE
+    temp_file = bundle_file + '.tmp'
+    with open(temp_file, 'wb') as bundle:
+        bundle.write(BUNDLE_MAGIC)
+        bundle.write(struct.pack('<I', len(index_bytes)))
+        bundle.write(index_bytes)
+        bundle.write(b'\0' * padding)
+        for pcm in pcm_chunks:
+            bundle.write(pcm)
+    os.replace(temp_file, bundle_file)
+    return index
+
+# Read only view of a built bundle
+class AudioBundle:
+    def __init__(self, bundle_file):
+        with open(bundle_file, 'rb') as bundle:
+            self.mmap = mmap.mmap(bundle.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[:len(BUNDLE_MAGIC)] != BUNDLE_MAGIC:
+            raise ValueError(f"{bundle_file} is not an audio bundle")
+        index_start = len(BUNDLE_MAGIC) + 4
+        index_length = struct.unpack('<I', self.mmap[len(BUNDLE_MAGIC):index_start])[0]
+        self.index = json.loads(self.mmap[index_start:index_start + index_length])
+        if self.index["sample_rate"] != SAMPLE_RATE:
+            raise ValueError(f"{bundle_file} was built at {self.index['sample_rate']} Hz, expected {SAMPLE_RATE} Hz")
+        self.data_start = index_start + index_length
+        self.data_start += -self.data_start % PAGE_SIZE
+        self.view = memoryview(self.mmap)
+
+    def variants(self, voice, category):
+        return self.index["voices"].get(voice, {}).get(category, [])
+
+    def pcm(self, entry):
+        """ Zero copy int16 view of one clip """
+        start = self.data_start + entry["offset"]
+        return np.frombuffer(self.view[start:start + entry["frames"] * 2], dtype=np.int16)
+
+    def random_source(self, voice, category):
+        """ Source for a random variant of the category or None if the bundle has none """
+        variants = self.variants(voice, category)
+        if len(variants) == 0:
+            return None
+        return BufferSource(self.pcm(random.choice(variants)))
+
+# Load the bundle if it has been built
+def load_bundle(bundle_file):
+    if not os.path.exists(bundle_file):
+        logging.warning(f"No audio bundle at {bundle_file} - canned clips will be decoded on every play")
+        return None
+    try:
+        return AudioBundle(bundle_file)
+    except Exception as e:
+        logging.error(f"Unable to load audio bundle {bundle_file}: {e}")
+        return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG)
+    audio_dir = sys.argv[1] if len(sys.argv) > 1 else 'audio'
+    bundle_file = sys.argv[2] if len(sys.argv) > 2 else os.path.join(audio_dir, 'clips.bundle')
+    index = build_bundle(audio_dir, bundle_file)
+    for voice, categories in index["voices"].items():
+        logging.info(f"{voice}: " + ", ".join(f"{category} x{len(variants)}" for category, variants in categories.items()))
+    logging.info(f"Wrote {bundle_file}")
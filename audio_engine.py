@@ -0,0 +1,274 @@
+import logging
+import threading
+import collections
+import struct
+import wave
+import numpy as np
+
+# Single long lived audio output for the process. Every sound (intro WAV, canned clips,
+# live TTS) is a PCM source fed to a mixer thread that writes to one output stream
+
+# Format of the output stream, matches what TTS sends back for audio/wav
+SAMPLE_RATE = 22050
+CHANNELS = 1
+FRAMES_PER_BUFFER = 1024
+
+# Playback priorities, lower priority sources are ducked while a higher one plays
+PRIORITY_CLIP = 1
+PRIORITY_COMMENTARY = 2
+
+# Linear resample of mono int16 samples
+def resample(samples, from_rate, to_rate=SAMPLE_RATE):
+    if from_rate == to_rate or len(samples) == 0:
+        return samples
+    target_length = int(round(len(samples) * to_rate / from_rate))
+    positions = np.linspace(0, len(samples) - 1, target_length)
+    return np.interp(positions, np.arange(len(samples)), samples).astype(np.int16)
+
+# Mix interleaved int16 samples down to mono
+def to_mono(samples, channels):
+    if channels == 1:
+        return samples
+    return samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+
+# Source of PCM samples already held in memory. Wraps the buffer without copying it
+class BufferSource:
+    def __init__(self, pcm):
+        if isinstance(pcm, np.ndarray):
+            self.samples = pcm
+        else:
+            self.samples = np.frombuffer(pcm, dtype=np.int16)
+        self.position = 0
+
+    def read(self, frames):
+        """ Return up to frames samples, fewer once the source runs dry """
+        chunk = self.samples[self.position:self.position + frames]
+        self.position += len(chunk)
+        return chunk
+
+    def finished(self):
+        return self.position >= len(self.samples)
+
+    def wait_readable(self, timeout=None):
+        return True
+
+# Source fed with live audio chunks as they arrive, e.g. from a TTS websocket.
+# A leading WAV header is parsed and stripped when wav is True
+class StreamSource:
+    def __init__(self, wav=True):
+        self.pending = bytearray()
+        self.samples = collections.deque()
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.readable = threading.Condition(self.lock)
+        self.closed = False
+        self.in_header = wav
+        self.rate = SAMPLE_RATE
+        self.channels = CHANNELS
+
+    def write(self, data):
+        with self.lock:
+            self.pending += data
+            if self.in_header and not self._parse_header():
+                return
+            # Only hand whole frames to the mixer
+            frame_bytes = 2 * self.channels
+            usable = len(self.pending) - len(self.pending) % frame_bytes
+            if usable == 0:
+                return
+            samples = np.frombuffer(bytes(self.pending[:usable]), dtype=np.int16)
+            del self.pending[:usable]
+            samples = resample(to_mono(samples, self.channels), self.rate)
+            self.samples.append(samples)
+            self.buffered += len(samples)
+            self.readable.notify_all()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.readable.notify_all()
+
+    def wait_readable(self, timeout=None):
+        """ Block until there are samples to read or the source is closed """
+        with self.lock:
+            return self.readable.wait_for(lambda: self.buffered > 0 or self.closed, timeout)
+
+    def read(self, frames):
+        with self.lock:
+            chunks = []
+            needed = frames
+            while needed > 0 and len(self.samples) > 0:
+                chunk = self.samples[0]
+                if len(chunk) <= needed:
+                    chunks.append(self.samples.popleft())
+                    needed -= len(chunk)
+                else:
+                    chunks.append(chunk[:needed])
+                    self.samples[0] = chunk[needed:]
+                    needed = 0
+            self.buffered -= frames - needed
+        if len(chunks) == 0:
+            return np.zeros(0, dtype=np.int16)
+        return np.concatenate(chunks)
+
+    def finished(self):
+        with self.lock:
+            return self.closed and self.buffered == 0
+
+    def _parse_header(self):
+        # Walk the RIFF chunks up to the start of the data chunk, False until the whole header has arrived
+        if len(self.pending) < 12:
+            return False
+        if self.pending[:4] != b'RIFF' or self.pending[8:12] != b'WAVE':
+            # Raw PCM
+            self.in_header = False
+            return True
+        offset = 12
+        while len(self.pending) >= offset + 8:
+            chunk_id = bytes(self.pending[offset:offset + 4])
+            chunk_size = struct.unpack('<I', self.pending[offset + 4:offset + 8])[0]
+            if chunk_id == b'data':
+                del self.pending[:offset + 8]
+                self.in_header = False
+                if self.rate != SAMPLE_RATE:
+                    logging.warning(f"Resampling streamed audio from {self.rate} Hz to {SAMPLE_RATE} Hz")
+                return True
+            if len(self.pending) < offset + 8 + chunk_size:
+                return False
+            if chunk_id == b'fmt ':
+                self.channels, self.rate = struct.unpack('<HI', self.pending[offset + 10:offset + 16])
+            offset += 8 + chunk_size + chunk_size % 2
+        return False
+
+# Load a WAV file into a source
+def wav_file_source(file):
+    with wave.open(file, 'rb') as wf:
+        if wf.getsampwidth() != 2:
+            raise ValueError(f"{file} is not 16 bit PCM")
+        samples = np.frombuffer(wf.readframes(wf.getnframes()), dtype=np.int16)
+        return BufferSource(resample(to_mono(samples, wf.getnchannels()), wf.getframerate()))
+
+# Decode any clip (mp3, wav, flac ...) into a source
+def clip_source(file):
+    import miniaudio
+    decoded = miniaudio.decode_file(file,
+                                    output_format=miniaudio.SampleFormat.SIGNED16,
+                                    nchannels=CHANNELS,
+                                    sample_rate=SAMPLE_RATE)
+    return BufferSource(np.frombuffer(decoded.samples, dtype=np.int16))
+
+# A source playing on the mixer with its own gain envelope
+class Playback:
+    def __init__(self, source, priority):
+        self.source = source
+        self.priority = priority
+        self.gain = 1.0
+        self.fade_to = 1.0
+        self.fade_step = 0.0
+        self.stop_after_fade = False
+        self.done = threading.Event()
+
+    def fade(self, from_gain, to_gain, seconds, stop=False):
+        """ Ramp the gain linearly over seconds """
+        self.gain = from_gain
+        self.fade_to = to_gain
+        frames = max(1, int(seconds * SAMPLE_RATE))
+        self.fade_step = (to_gain - from_gain) / frames
+        self.stop_after_fade = stop
+
+    def stop(self, fade_out=0.0):
+        if fade_out > 0:
+            self.fade(self.gain, 0.0, fade_out, stop=True)
+        else:
+            self.done.set()
+
+    def wait(self, timeout=None):
+        """ Block until the source has been played out """
+        return self.done.wait(timeout)
+
+    def envelope(self, frames):
+        if self.fade_step == 0.0:
+            return self.gain
+        gains = self.gain + self.fade_step * np.arange(1, frames + 1)
+        if self.fade_step > 0:
+            gains = np.minimum(gains, self.fade_to)
+        else:
+            gains = np.maximum(gains, self.fade_to)
+        self.gain = float(gains[-1])
+        if self.gain == self.fade_to:
+            self.fade_step = 0.0
+            if self.stop_after_fade:
+                self.done.set()
+        return gains
+
+# Mixer thread writing every active playback to one persistent output stream
+class AudioEngine:
+    def __init__(self, duck_gain=0.3):
+        self.duck_gain = duck_gain
+        self.playbacks = []
+        self.condition = threading.Condition()
+        self.pyaudio = None
+        self.stream = None
+        self.thread = None
+
+    def play(self, source, priority=PRIORITY_CLIP, crossfade=0.0, kind=None):
+        """ Start playing a source. With crossfade, lower or equal priority sources fade out while this one fades in.
+            kind labels the sound (intro, clip, commentary) for outputs that forward it """
+        playback = Playback(source, priority)
+        with self.condition:
+            self._start()
+            if crossfade > 0:
+                faded_out = 0
+                for other in self.playbacks:
+                    if other.priority <= priority and not other.done.is_set():
+                        other.stop(fade_out=crossfade)
+                        faded_out += 1
+                if faded_out > 0:
+                    playback.fade(0.0, 1.0, crossfade)
+            self.playbacks.append(playback)
+            self.condition.notify()
+        return playback
+
+    def start(self):
+        """ Open the output device ahead of the first play """
+        with self.condition:
+            self._start()
+
+    def _start(self):
+        # Caller holds self.condition. The device is opened once and stays open.
+        # pyaudio is only imported here so servers streaming audio over the websocket don't need it
+        if self.thread is not None:
+            return
+        import pyaudio
+        self.pyaudio = pyaudio.PyAudio()
+        self.stream = self.pyaudio.open(format=pyaudio.paInt16,
+                                        channels=CHANNELS,
+                                        rate=SAMPLE_RATE,
+                                        output=True,
+                                        frames_per_buffer=FRAMES_PER_BUFFER)
+        self.thread = threading.Thread(target=self._mix, daemon=True)
+        self.thread.start()
+
+    def _mix(self):
+        while True:
+            with self.condition:
+                self.playbacks = [playback for playback in self.playbacks if not playback.done.is_set()]
+                while len(self.playbacks) == 0:
+                    self.condition.wait()
+                playbacks = list(self.playbacks)
+            top_priority = max(playback.priority for playback in playbacks)
+            mixed = np.zeros(FRAMES_PER_BUFFER, dtype=np.float32)
+            for playback in playbacks:
+                samples = playback.source.read(FRAMES_PER_BUFFER)
+                if len(samples) > 0:
+                    gain = playback.envelope(len(samples))
+                    if playback.priority < top_priority:
+                        gain = gain * self.duck_gain
+                    mixed[:len(samples)] += samples * gain
+                elif playback.stop_after_fade:
+                    # Nothing left to fade out
+                    playback.done.set()
+                if playback.source.finished():
+                    playback.done.set()
+            # The blocking write paces the mixer to the device
+            self.stream.write(np.clip(mixed, -32768, 32767).astype(np.int16).tobytes())
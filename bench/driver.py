@@ -0,0 +1,257 @@
+import sys
+import json
+import time
+import struct
+import logging
+import argparse
+import threading
+import collections
+import websocket
+
+# Replays a recorded /watsonx trace (TRACE_RECORD_FILE) as N concurrent simulator bays
+# with the original message timing and reports latency percentiles, deadline misses
+# and server memory.
+#
+# Run the server with AUDIO_OUTPUT=websocket so the audio comes back to the driver, e.g.
+# python bench/stub_servers.py &
+# LLM_BACKEND=stub LLM_STUB_URL=http://127.0.0.1:8601 TTS_AUTH=none TTS_URL=ws://127.0.0.1:8602 \
+#   TTS_PLAYER_PROFILE_URL=ws://127.0.0.1:8602 AUDIO_OUTPUT=websocket \
+#   gunicorn -b localhost:5000 --workers 1 --threads 20 wscommentary:app &
+# python bench/driver.py --trace bench/sample_trace.jsonl --bays 8 --server-pid <gunicorn pid>
+
+FRAME_HEADER = struct.Struct('<2sBIIQ')
+FLAG_LAST_FRAME = 1
+
+# Recorded connections in order, each a list of (offset, raw message)
+def load_trace(trace_file):
+    connections = collections.OrderedDict()
+    with open(trace_file, encoding='utf-8') as trace:
+        for line in trace:
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            connections.setdefault(entry["connection"], []).append((entry["offset"], entry["message"]))
+    return list(connections.values())
+
+# Give each bay its own player so profiles aren't shared between bays
+def retarget_message(payload_raw, bay):
+    payload_data = json.loads(payload_raw)
+    user_profile = payload_data.get("user_profile")
+    if user_profile is not None and "id" in user_profile:
+        user_profile["id"] = f"{user_profile['id']}-bay{bay}"
+        intro_data = user_profile.get("apex_preferences", {}).get("intro_data")
+        if intro_data is not None and "id" in intro_data:
+            intro_data["id"] = user_profile["id"]
+    return payload_data["type"], payload_data, json.dumps(payload_data)
+
+# p50/p90/p99 of a list of secs
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    def at(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {"count": len(ordered), "p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": ordered[-1]}
+
+# Resident memory in KB of a process and its children (the profile workers)
+def process_tree_rss_kb(pid):
+    total = 0
+    pids = [pid]
+    while len(pids) > 0:
+        current = pids.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                for line in status:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pids.extend(int(child) for child in children.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+class MemorySampler:
+    def __init__(self, pid, interval=0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _sample(self):
+        while not self.stopped.is_set():
+            self.samples.append(process_tree_rss_kb(self.pid))
+            self.stopped.wait(self.interval)
+
+# One simulator bay replaying a recorded connection
+class Bay:
+    def __init__(self, bay, url, messages, speedup, drain):
+        self.bay = bay
+        self.url = url
+        self.messages = messages
+        self.speedup = speedup
+        self.drain = drain
+        self.sent = []
+        self.received = []
+        self.error = None
+
+    def run(self):
+        try:
+            ws = websocket.create_connection(self.url)
+        except Exception as e:
+            self.error = f"unable to connect: {e}"
+            return
+        reader = threading.Thread(target=self._read, args=(ws,), daemon=True)
+        reader.start()
+        start = time.perf_counter()
+        try:
+            for offset, payload_raw in self.messages:
+                delay = start + offset / self.speedup - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                message_type, payload_data, payload_raw = retarget_message(payload_raw, self.bay)
+                self.sent.append((time.perf_counter(), message_type, payload_data))
+                ws.send(payload_raw)
+            time.sleep(self.drain)
+        except Exception as e:
+            self.error = f"send failed: {e}"
+        finally:
+            ws.close()
+            reader.join(timeout=2.0)
+
+    def _read(self, ws):
+        while True:
+            try:
+                opcode, data = ws.recv_data()
+            except Exception:
+                return
+            received_at = time.perf_counter()
+            if opcode == websocket.ABNF.OPCODE_TEXT:
+                self.received.append((received_at, "text", data.decode('utf-8')))
+            elif opcode == websocket.ABNF.OPCODE_BINARY and len(data) >= FRAME_HEADER.size:
+                magic, flags, stream_id, sequence, timestamp = FRAME_HEADER.unpack_from(data)
+                self.received.append((received_at, "audio", (stream_id, sequence, flags & FLAG_LAST_FRAME)))
+            elif opcode == websocket.ABNF.OPCODE_CLOSE:
+                return
+
+# Work out per stage timings for one bay
+def analyze_bay(bay, metrics, deadline_tolerance):
+    acks = []
+    streams = {}
+    for received_at, kind, data in bay.received:
+        if kind == "text":
+            message = None
+            if data.startswith("{"):
+                message = json.loads(data)
+            if message is not None and message.get("type") == "audio_start":
+                streams[message["stream"]] = {"kind": message["kind"], "start": received_at, "first_frame": None}
+            else:
+                acks.append(received_at)
+        else:
+            stream = streams.get(data[0])
+            if stream is not None and stream["first_frame"] is None:
+                stream["first_frame"] = received_at
+    # Every message gets one reply, in order
+    for (sent_at, message_type, payload_data), acked_at in zip(bay.sent, acks):
+        metrics[f"ack {message_type}"].append(acked_at - sent_at)
+    by_kind = collections.defaultdict(list)
+    for stream in streams.values():
+        if stream["first_frame"] is not None:
+            by_kind[stream["kind"]].append(stream)
+    shot_times = [sent_at for sent_at, message_type, payload_data in bay.sent if message_type == "shot_data"]
+    for sent_at, message_type, payload_data in bay.sent:
+        later_shots = [shot_at for shot_at in shot_times if shot_at > sent_at]
+        window_end = later_shots[0] if len(later_shots) > 0 else float('inf')
+        def first_stream(kind):
+            candidates = [stream for stream in by_kind[kind] if sent_at <= stream["start"] < window_end]
+            return min(candidates, key=lambda stream: stream["start"]) if len(candidates) > 0 else None
+        if message_type == "game_and_environment_data":
+            intro = first_stream("intro")
+            if intro is not None:
+                metrics["intro first audio"].append(intro["first_frame"] - sent_at)
+        elif message_type == "shot_data":
+            shot_time = payload_data['shot_complete']['data']['segments'][-1]['points'][-1]['time']
+            clip = first_stream("clip")
+            if clip is not None:
+                metrics["clip first audio"].append(clip["first_frame"] - sent_at)
+            commentary = first_stream("commentary")
+            deadline = sent_at + shot_time - 0.5
+            metrics["shots"].append(1)
+            if commentary is None:
+                metrics["deadline misses"].append(1)
+                continue
+            metrics["commentary first audio"].append(commentary["first_frame"] - sent_at)
+            lateness = commentary["first_frame"] - deadline
+            metrics["commentary lateness"].append(lateness)
+            if lateness > deadline_tolerance:
+                metrics["deadline misses"].append(1)
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay a /watsonx trace as concurrent simulator bays")
+    parser.add_argument("--url", default="ws://127.0.0.1:5000/watsonx")
+    parser.add_argument("--trace", default="bench/sample_trace.jsonl")
+    parser.add_argument("--bays", type=int, default=4, help="concurrent connections, recorded connections are reused round robin")
+    parser.add_argument("--speedup", type=float, default=1.0, help="replay faster (>1) or slower (<1) than recorded")
+    parser.add_argument("--stagger", type=float, default=0.1, help="secs between bays starting")
+    parser.add_argument("--drain", type=float, default=10.0, help="secs to keep each connection open after its last message")
+    parser.add_argument("--deadline-tolerance", type=float, default=0.25,
+                        help="secs the end commentary can start after shot_time - 0.5 before it counts as a miss")
+    parser.add_argument("--server-pid", type=int, help="sample this process's memory, children included")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    connections = load_trace(args.trace)
+    if len(connections) == 0:
+        logging.error(f"No connections in {args.trace}")
+        return 1
+    bays = [Bay(bay, args.url, connections[bay % len(connections)], args.speedup, args.drain) for bay in range(args.bays)]
+    sampler = MemorySampler(args.server_pid) if args.server_pid else None
+    if sampler is not None:
+        sampler.start()
+    threads = []
+    for bay in bays:
+        thread = threading.Thread(target=bay.run, daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.stagger)
+    for thread in threads:
+        thread.join()
+    if sampler is not None:
+        sampler.stop()
+
+    metrics = collections.defaultdict(list)
+    for bay in bays:
+        if bay.error is not None:
+            logging.error(f"Bay {bay.bay}: {bay.error}")
+        analyze_bay(bay, metrics, args.deadline_tolerance)
+    results = {"bays": args.bays,
+               "errors": sum(1 for bay in bays if bay.error is not None),
+               "shots": len(metrics.pop("shots", [])),
+               "deadline_misses": len(metrics.pop("deadline misses", [])),
+               "latency": {stage: percentiles(values) for stage, values in sorted(metrics.items())}}
+    if sampler is not None and len(sampler.samples) > 0:
+        results["server_rss_kb"] = {"start": sampler.samples[0], "peak": max(sampler.samples), "end": sampler.samples[-1]}
+
+    print(f"{args.bays} bays, {results['errors']} errors, {results['shots']} shots, {results['deadline_misses']} deadline misses")
+    print(f"{'stage (secs)':<28}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for stage, summary in results["latency"].items():
+        print(f"{stage:<28}{summary['count']:>7}{summary['p50']:>9.3f}{summary['p90']:>9.3f}{summary['p99']:>9.3f}{summary['max']:>9.3f}")
+    if "server_rss_kb" in results:
+        rss = results["server_rss_kb"]
+        print(f"server RSS MB start {rss['start'] / 1024:.1f} peak {rss['peak'] / 1024:.1f} end {rss['end'] / 1024:.1f}")
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,142 @@
+import sys
+import json
+import time
+import random
+import struct
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from flask import Flask
+from flask_sock import Sock
+from werkzeug.serving import make_server
+
+# Local stand-ins for watsonx.ai text generation and the TTS synthesize websocket
+# with configurable latency and jitter, so load tests never touch the paid services.
+#
+# Run with:
+# python bench/stub_servers.py --llm-port 8601 --tts-port 8602
+#
+# and point the server at them with
+# LLM_BACKEND=stub LLM_STUB_URL=http://127.0.0.1:8601 TTS_AUTH=none TTS_URL=ws://127.0.0.1:8602 TTS_PLAYER_PROFILE_URL=ws://127.0.0.1:8602
+
+player_profile_commentary = ("Welcome to Pebble Beach and the stunning par-3 7th hole. "
+                             "Our next player hails from California and has been playing for a decade. "
+                             "They play about twenty rounds a year and carry a solid handicap. "
+                             "Their favourite golfer is Tiger Woods, which explains the confident stride. "
+                             "Let's see what they can do with this tee shot.")
+
+end_commentaries = ["What a lovely strike, that one settled nicely on the green. The pin is well within reach from there. A great chance for birdie awaits.",
+                    "That one found the water, and a one-stroke penalty follows. The wind had a say in that flight. Plenty of golf left to play on this hole.",
+                    "A touch short of the target there. The shape was lovely all the same. Expect a confident approach from here."]
+
+# Latency drawn from a normal distribution, never negative
+def draw_latency(mean, jitter):
+    return max(0.0, random.gauss(mean, jitter))
+
+def commentary_for(prompt):
+    if "introducing a golf player" in prompt:
+        commentary = player_profile_commentary
+    else:
+        commentary = random.choice(end_commentaries)
+    return json.dumps({"commentary": commentary})
+
+# Mimics Model.generate_text and Model.generate_text_stream
+class LLMStubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    latency = 1.0
+    jitter = 0.2
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        prompt = request["prompt"]
+        if self.path == "/generate":
+            time.sleep(draw_latency(self.latency, self.jitter))
+            generated_text = commentary_for(prompt)
+            body = json.dumps({"generated_text": generated_text}).encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path == "/generate_stream":
+            # Spread the tokens evenly over the generation latency
+            generated_text = commentary_for(prompt)
+            tokens = [generated_text[offset:offset + 4] for offset in range(0, len(generated_text), 4)]
+            token_delay = draw_latency(self.latency, self.jitter) / len(tokens)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(token_delay)
+                    data = token.encode('utf-8')
+                    self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client cut generation off
+                pass
+        else:
+            self.send_error(404)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+# Streaming WAV header with unknown length, like the TTS service sends
+def streaming_wav_header(sample_rate):
+    return (b'RIFF' + struct.pack('<I', 0xFFFFFFFF) + b'WAVE' +
+            b'fmt ' + struct.pack('<IHHIIHH', 16, 1, 1, sample_rate, sample_rate * 2, 2, 16) +
+            b'data' + struct.pack('<I', 0xFFFFFFFF))
+
+# Mimics the TTS synthesize websocket: one request per connection, audio as binary frames
+def create_tts_stub_app(first_byte_latency, jitter, realtime_factor, secs_per_word, sample_rate=22050):
+    tts_app = Flask(__name__)
+    tts_sock = Sock(tts_app)
+
+    @tts_sock.route('/v1/synthesize')
+    def synthesize(ws):
+        request = json.loads(ws.receive())
+        ws.send(json.dumps({"binary_streams": [{"content_type": "audio/wav"}]}))
+        time.sleep(draw_latency(first_byte_latency, jitter))
+        ws.send(streaming_wav_header(sample_rate))
+        audio_secs = max(0.5, len(request["text"].split()) * secs_per_word)
+        chunk_secs = 0.1
+        chunk = b'\0\0' * int(sample_rate * chunk_secs)
+        for _ in range(int(audio_secs / chunk_secs)):
+            ws.send(chunk)
+            if realtime_factor > 0:
+                time.sleep(chunk_secs / realtime_factor)
+
+    return tts_app
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Local watsonx.ai and TTS stubs for load testing")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--llm-port", type=int, default=8601)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="mean secs to generate a response")
+    parser.add_argument("--llm-jitter", type=float, default=0.2, help="standard deviation of the LLM latency")
+    parser.add_argument("--tts-port", type=int, default=8602)
+    parser.add_argument("--tts-first-byte", type=float, default=0.2, help="mean secs before the first audio")
+    parser.add_argument("--tts-jitter", type=float, default=0.05, help="standard deviation of the first byte latency")
+    parser.add_argument("--tts-realtime-factor", type=float, default=5.0,
+                        help="how much faster than real time audio is produced, 0 for as fast as possible")
+    parser.add_argument("--tts-secs-per-word", type=float, default=0.35)
+    args = parser.parse_args(argv)
+
+    LLMStubHandler.latency = args.llm_latency
+    LLMStubHandler.jitter = args.llm_jitter
+    llm_server = ThreadingHTTPServer((args.host, args.llm_port), LLMStubHandler)
+    threading.Thread(target=llm_server.serve_forever, daemon=True).start()
+    logging.info(f"LLM stub on http://{args.host}:{args.llm_port}")
+
+    tts_app = create_tts_stub_app(args.tts_first_byte, args.tts_jitter, args.tts_realtime_factor, args.tts_secs_per_word)
+    tts_server = make_server(args.host, args.tts_port, tts_app, threaded=True)
+    logging.info(f"TTS stub on ws://{args.host}:{args.tts_port}")
+    tts_server.serve_forever()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main(sys.argv[1:])
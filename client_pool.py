@@ -0,0 +1,60 @@
+import threading
+import contextlib
+
+# Thread safe pool of reusable clients (LLM models, TTS services).
+# Clients are built on demand by the factory up to max_size, then borrowers wait for one to be returned
+class ClientPool:
+    def __init__(self, factory, max_size=8, name="client"):
+        self.factory = factory
+        self.max_size = max_size
+        self.name = name
+        self.idle = []
+        self.created = 0
+        self.condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def borrow(self, timeout=None):
+        """ Borrow a client for the duration of a with block """
+        client = self.acquire(timeout)
+        try:
+            yield client
+        finally:
+            self.release(client)
+
+    def acquire(self, timeout=None):
+        with self.condition:
+            if len(self.idle) == 0 and self.created >= self.max_size:
+                if not self.condition.wait_for(lambda: len(self.idle) > 0, timeout):
+                    raise TimeoutError(f"No {self.name} available after {timeout} secs")
+            if len(self.idle) > 0:
+                return self.idle.pop()
+            self.created += 1
+        try:
+            # Build outside the lock, client construction can mean network round trips
+            return self.factory()
+        except Exception:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def prefill(self, count=1):
+        """ Build clients ahead of the first borrow until count exist """
+        while True:
+            with self.condition:
+                if self.created >= min(count, self.max_size):
+                    return
+                self.created += 1
+            try:
+                client = self.factory()
+            except Exception:
+                with self.condition:
+                    self.created -= 1
+                    self.condition.notify()
+                raise
+            self.release(client)
+
+    def release(self, client):
+        with self.condition:
+            self.idle.append(client)
+            self.condition.notify()
@@ -0,0 +1,49 @@
+import re
+import json
+import functools
+
+# Text rewriting between the LLM and TTS, driven by a lexicon file such as lexicon.json:
+#
+# {
+#   "breaks": [{"text": " - ", "strength": "weak"}],          text replaced by an SSML break
+#   "strip": ["[Potentially harmful text removed]"],           text removed, e.g. moderation markers
+#   "phonemes": [{"word": "putting", "ph": ".1pH.0diG"}]       whole words (any case) spoken as ph
+# }
+#
+# Every rule is compiled into one regex so the text is rewritten in a single pass however many rules
+# there are. Rewrites are memoized, streamed commentary is rewritten a complete sentence at a time
+
+class Lexicon:
+    def __init__(self, breaks=(), strip=(), phonemes=(), cache_size=1024):
+        alternatives = []
+        self.replacements = {}
+        # Longest first so a literal never loses out to one of its own prefixes
+        literals = {rule["text"]: f'<break strength="{rule.get("strength", "weak")}"/>' for rule in breaks}
+        literals.update({text: "" for text in strip})
+        for index, text in enumerate(sorted(literals, key=len, reverse=True)):
+            alternatives.append(f"(?P<literal{index}>{re.escape(text)})")
+            self.replacements[f"literal{index}"] = literals[text]
+        for index, rule in enumerate(phonemes):
+            alternatives.append(fr"(?P<phoneme{index}>\b(?i:{re.escape(rule['word'])})\b)")
+            self.replacements[f"phoneme{index}"] = (rule.get("alphabet", "ibm"), rule["ph"])
+        self.pattern = re.compile("|".join(alternatives)) if len(alternatives) > 0 else None
+        self.rewrite = functools.lru_cache(maxsize=cache_size)(self._rewrite)
+
+    @classmethod
+    def load(cls, lexicon_file, cache_size=1024):
+        with open(lexicon_file, encoding='utf-8') as lexicon_json:
+            rules = json.load(lexicon_json)
+        return cls(breaks=rules.get("breaks", ()), strip=rules.get("strip", ()),
+                   phonemes=rules.get("phonemes", ()), cache_size=cache_size)
+
+    def replace(self, match):
+        replacement = self.replacements[match.lastgroup]
+        if isinstance(replacement, tuple):
+            alphabet, ph = replacement
+            return f"<phoneme alphabet='{alphabet}' ph='{ph}'>{match.group()}</phoneme>"
+        return replacement
+
+    def _rewrite(self, text):
+        if self.pattern is None:
+            return text
+        return self.pattern.sub(self.replace, text)
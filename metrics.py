@@ -0,0 +1,148 @@
+import time
+import threading
+import contextlib
+
+# Process wide latency histograms, counters and gauges rendered in the Prometheus text format.
+# Profile worker processes can't share memory with the serving process so they forward
+# their samples (see MetricsRegistry.forward_to) and the serving process applies them.
+#
+# Each gunicorn worker has its own registry, scrape each worker or run with --workers 1
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for name, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value))
+
+class Histogram:
+    def __init__(self, registry, name, help_text, buckets=DEFAULT_BUCKETS, label_names=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        self.label_names = tuple(label_names)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        if self.registry.forward is not None:
+            self.registry.forward((self.name, label_values, value))
+            return
+        self.apply(label_values, value)
+
+    def apply(self, label_values, value):
+        with self.lock:
+            counts, total = self.series.get(label_values, (None, 0.0))
+            if counts is None:
+                counts = [0] * len(self.buckets)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.series[label_values] = (counts, total + value)
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """ Observe how long the with block takes """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, (counts, total) in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, [("le", format_value(bound))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+class Counter:
+    def __init__(self, registry, name, help_text, label_names=()):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        if self.registry.forward is not None:
+            self.registry.forward((self.name, label_values, amount))
+            return
+        self.apply(label_values, amount)
+
+    def apply(self, label_values, amount):
+        with self.lock:
+            self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            series = sorted(self.series.items())
+        for label_values, value in series:
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+# Gauge read from a function when scraped
+class Gauge:
+    def __init__(self, registry, name, help_text, function):
+        self.registry = registry
+        self.name = name
+        self.help_text = help_text
+        self.function = function
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge",
+                f"{self.name} {format_value(self.function())}"]
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+        self.forward = None
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, label_names=()):
+        return self._register(Histogram(self, name, help_text, buckets, label_names))
+
+    def counter(self, name, help_text, label_names=()):
+        return self._register(Counter(self, name, help_text, label_names))
+
+    def gauge(self, name, help_text, function):
+        return self._register(Gauge(self, name, help_text, function))
+
+    def forward_to(self, send):
+        """ Send samples to send((name, label values, value)) instead of recording them here """
+        self.forward = send
+
+    def apply(self, sample):
+        """ Record a sample forwarded from another process """
+        name, label_values, value = sample
+        self.metrics[name].apply(tuple(label_values), value)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def _register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+registry = MetricsRegistry()
@@ -0,0 +1,181 @@
+import os
+import re
+import time
+import sqlite3
+import logging
+import threading
+import contextlib
+import collections
+
+# Store for the synthesized player profile intros.
+# Each intro is written to <root>/<voice>/<player id>.wav.part and renamed into place once
+# complete, then recorded in an sqlite index of player id, voice, size, created and last used.
+# Intros older than ttl secs are dropped and the least recently used go first when the total size
+# goes over max_bytes, so lookups and eviction never need to scan the directory.
+# Players at a bay are kept in a hot in memory tier until their session releases them.
+# .part files aren't indexed, any left by a process that died mid-synthesis are swept when the
+# store is opened once they haven't been written to for stale_part_secs.
+#
+# The profile workers write to the store and the serving processes read from it, the index is what
+# they share. Workers only ever call commit, the memory tier and its lock belong to the serving process
+
+# Player ids come from the simulator, never let one reach outside the store
+def check_player_id(player_id):
+    if player_id == "" or player_id.startswith('.') or '/' in player_id or '\\' in player_id:
+        raise ValueError(f"Invalid player id {player_id!r}")
+
+# Voices come from the ?voice= query parameter, only TTS voice names such as en-US_EmmaExpressive
+voice_pattern = re.compile(r'^[A-Za-z0-9][A-Za-z0-9_-]*$')
+
+def check_voice(voice):
+    if not isinstance(voice, str) or voice_pattern.match(voice) is None:
+        raise ValueError(f"Invalid voice {voice!r}")
+
+class ProfileAudioStore:
+    def __init__(self, root, ttl=86400, max_bytes=512 * 1024 * 1024, memory_max_bytes=32 * 1024 * 1024,
+                 stale_part_secs=300):
+        self.root = root
+        self.ttl = ttl
+        self.stale_part_secs = stale_part_secs
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        # (player id, voice) -> (created, audio)
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.index_file = os.path.join(root, "index.db")
+        with self._index() as index:
+            index.execute("PRAGMA journal_mode=WAL")
+            index.execute("CREATE TABLE IF NOT EXISTS profiles (player_id TEXT, voice TEXT, size INTEGER, "
+                          "created REAL, last_used REAL, PRIMARY KEY (player_id, voice))")
+            self._evict(index)
+        self._sweep_parts()
+
+    def path(self, player_id, voice):
+        """ Where the player's intro lives once it is complete """
+        check_player_id(player_id)
+        check_voice(voice)
+        return os.path.join(self.root, voice, player_id + ".wav")
+
+    def part_path(self, player_id, voice):
+        """ Where the player's intro is written while it is being synthesized """
+        return self.path(player_id, voice) + ".part"
+
+    def open_part(self, player_id, voice):
+        part_path = self.part_path(player_id, voice)
+        os.makedirs(os.path.dirname(part_path), exist_ok=True)
+        return open(part_path, 'wb')
+
+    def commit(self, player_id, voice):
+        """ Move a complete .part file into place and index it """
+        part_path = self.part_path(player_id, voice)
+        size = os.path.getsize(part_path)
+        os.replace(part_path, self.path(player_id, voice))
+        now = time.time()
+        with self._index() as index:
+            index.execute("INSERT OR REPLACE INTO profiles VALUES (?, ?, ?, ?, ?)", (player_id, voice, size, now, now))
+            self._evict(index)
+
+    def discard(self, player_id, voice):
+        """ Drop a failed .part file """
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.part_path(player_id, voice))
+
+    def load(self, player_id, voice):
+        """ The player's intro audio, None when there isn't one or it has expired """
+        key = (player_id, voice)
+        with self._index() as index:
+            row = index.execute("SELECT created FROM profiles WHERE player_id = ? AND voice = ? AND created >= ?",
+                                (player_id, voice, time.time() - self.ttl)).fetchone()
+            if row is None:
+                return None
+            created = row[0]
+            index.execute("UPDATE profiles SET last_used = ? WHERE player_id = ? AND voice = ?",
+                          (time.time(), player_id, voice))
+        with self.lock:
+            entry = self.memory.get(key)
+            # A newer intro may have been committed since this one was loaded
+            if entry is not None and entry[0] == created:
+                self.memory.move_to_end(key)
+                return entry[1]
+        try:
+            with open(self.path(player_id, voice), 'rb') as profile_audio:
+                audio = profile_audio.read()
+        except FileNotFoundError:
+            logging.error(f"Profile audio for player_id {player_id} is indexed but missing")
+            with self._index() as index:
+                index.execute("DELETE FROM profiles WHERE player_id = ? AND voice = ?", (player_id, voice))
+            return None
+        self._put_memory(key, created, audio)
+        return audio
+
+    def release(self, player_id, voice):
+        """ The player has left the bay, drop them from the memory tier """
+        with self.lock:
+            entry = self.memory.pop((player_id, voice), None)
+            if entry is not None:
+                self.memory_size -= len(entry[1])
+
+    def size(self):
+        with self._index() as index:
+            return index.execute("SELECT COALESCE(SUM(size), 0) FROM profiles").fetchone()[0]
+
+    def _put_memory(self, key, created, audio):
+        with self.lock:
+            previous = self.memory.pop(key, None)
+            if previous is not None:
+                self.memory_size -= len(previous[1])
+            self.memory[key] = (created, audio)
+            self.memory_size += len(audio)
+            while self.memory_size > self.memory_max_bytes and len(self.memory) > 0:
+                evicted_key, (evicted_created, evicted_audio) = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted_audio)
+
+    def _evict(self, index):
+        # Expired intros first, then least recently used until the store is back to 90% of its cap
+        cutoff = time.time() - self.ttl
+        evicted = index.execute("SELECT player_id, voice, size FROM profiles WHERE created < ?", (cutoff,)).fetchall()
+        total = index.execute("SELECT COALESCE(SUM(size), 0) FROM profiles WHERE created >= ?", (cutoff,)).fetchone()[0]
+        if total > self.max_bytes:
+            for player_id, voice, size in index.execute("SELECT player_id, voice, size FROM profiles "
+                                                        "WHERE created >= ? ORDER BY last_used", (cutoff,)).fetchall():
+                if total <= self.max_bytes * 0.9:
+                    break
+                evicted.append((player_id, voice, size))
+                total -= size
+        for player_id, voice, size in evicted:
+            index.execute("DELETE FROM profiles WHERE player_id = ? AND voice = ?", (player_id, voice))
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.path(player_id, voice))
+        if len(evicted) > 0:
+            logging.debug(f"Evicted {len(evicted)} profile intros, {total} bytes left")
+
+    def _sweep_parts(self):
+        # Intros being written are touched with every chunk, only long untouched ones are orphans
+        cutoff = time.time() - self.stale_part_secs
+        swept = 0
+        for voice in os.listdir(self.root):
+            voice_dir = os.path.join(self.root, voice)
+            if not os.path.isdir(voice_dir):
+                continue
+            for file_name in os.listdir(voice_dir):
+                if not file_name.endswith(".part"):
+                    continue
+                part_path = os.path.join(voice_dir, file_name)
+                with contextlib.suppress(FileNotFoundError):
+                    if os.path.getmtime(part_path) < cutoff:
+                        os.remove(part_path)
+                        swept += 1
+        if swept > 0:
+            logging.debug(f"Swept {swept} orphaned profile intro .part files")
+
+    @contextlib.contextmanager
+    def _index(self):
+        # A connection per use, they can't be shared between threads or across a fork
+        index = sqlite3.connect(self.index_file, timeout=10.0)
+        try:
+            with index:
+                yield index
+        finally:
+            index.close()
@@ -0,0 +1,223 @@
+import sys
+import csv
+import json
+import logging
+import argparse
+import numpy as np
+from shot_profile import parse_message, classify_shot, format_distance_to_pin, get_init_commentary_category
+
+# Offline re-scoring of logged shots. Streams a JSONL file of shot_data messages in chunks into
+# columnar NumPy arrays and applies the same rules as classify_shot and get_init_commentary_category
+# as vectorised masks, so memory stays bounded by the chunk size however many shots there are.
+#
+# Run with:
+# python shot_analytics.py shots.jsonl [--output summary.csv] [--chunk-size 100000] [--verify]
+#
+# The summary has one row per (outcome, penalty, distance bucket, clip category) with the number of
+# shots, their share and mean shot time. outcome is the classified terrain type ("none" when the
+# commentary ignores the terrain), penalty is set for water and out of bounds (default) shots,
+# distance bucket is the unit the distance to pin is given in (feet, yards or none).
+# --verify checks every shot against the per shot functions and fails on any difference
+
+# Terrain codes, anything not listed here gets a code as it is seen in that analyze() call
+NO_TERRAIN = 0
+known_terrain_names = (None, "default", "dirt", "deep_grass", "wood", "green", "tee_box", "water", "hole in one")
+DEFAULT, DIRT, DEEP_GRASS, WOOD, GREEN, TEE_BOX, WATER, HOLE_IN_ONE = range(1, 9)
+
+distance_buckets = ["none", "feet", "yards"]
+clip_categories = ["good", "tee_box", "water_default", "short", "average"]
+
+# One chunk of shots as columns. terrain_names and terrain_codes are the analyze() call's own
+# code tables, new terrains are added to them as they are seen
+class ShotColumns:
+    def __init__(self, size, terrain_names, terrain_codes):
+        self.terrain_names = terrain_names
+        self.terrain_codes = terrain_codes
+        self.shot_time = np.empty(size, dtype=np.float64)
+        self.pin_distance = np.empty(size, dtype=np.float64)
+        self.x = np.empty(size, dtype=np.float64)
+        self.y = np.empty(size, dtype=np.float64)
+        self.terrain = np.empty(size, dtype=np.int32)
+        self.in_hole = np.empty(size, dtype=bool)
+        self.count = 0
+
+    def append(self, shot_fields):
+        index = self.count
+        self.shot_time[index] = shot_fields['shot_time']
+        # None compares as NaN, never over a threshold
+        self.pin_distance[index] = np.nan if shot_fields['pin_distance'] is None else shot_fields['pin_distance']
+        self.x[index] = shot_fields['x']
+        self.y[index] = shot_fields['y']
+        terrain_type = shot_fields['terrain_type']
+        code = self.terrain_codes.get(terrain_type)
+        if code is None:
+            code = len(self.terrain_names)
+            self.terrain_names.append(terrain_type)
+            self.terrain_codes[terrain_type] = code
+        self.terrain[index] = code
+        self.in_hole[index] = shot_fields['final_resting_state'] == "hole"
+        self.count += 1
+
+# Vectorised classify_shot + get_init_commentary_category + distance unit for a chunk.
+# Returns (terrain codes, pin distances, distance bucket codes, clip category codes)
+def classify_columns(columns):
+    count = columns.count
+    terrain = columns.terrain[:count].copy()
+    pin_distance = columns.pin_distance[:count].copy()
+    shot_time = columns.shot_time[:count]
+    x = columns.x[:count]
+    y = columns.y[:count]
+    with np.errstate(invalid='ignore'):
+        terrain[(y < -69900) & (x > -21361) & (terrain == DEFAULT)] = NO_TERRAIN
+        terrain[np.isin(terrain, (DIRT, DEEP_GRASS, WOOD))] = NO_TERRAIN
+        terrain[(terrain == GREEN) & (pin_distance >= 2743.19995)] = NO_TERRAIN
+        terrain[(shot_time > 5) & (terrain == TEE_BOX)] = NO_TERRAIN
+        terrain[columns.in_hole[:count]] = HOLE_IN_ONE
+        pin_distance[np.isin(terrain, (HOLE_IN_ONE, WATER, DEFAULT))] = np.nan
+
+        distance_bucket = np.select([np.isnan(pin_distance), pin_distance >= 2743.19995], [0, 2], default=1)
+        clip_category = np.select([np.isin(terrain, (GREEN, HOLE_IN_ONE)),
+                                   terrain == TEE_BOX,
+                                   np.isin(terrain, (WATER, DEFAULT)),
+                                   (shot_time < 5.5) & (pin_distance >= 2743.19)],
+                                  [0, 1, 2, 3], default=4)
+    return terrain, pin_distance, distance_bucket, clip_category
+
+def distance_bucket_of(pin_distance):
+    formatted = format_distance_to_pin(pin_distance)
+    if formatted is None:
+        return "none"
+    return formatted.rsplit(' ', 1)[1]
+
+# Compare a chunk's vectorised results with the per shot functions, returns the number of differences
+def verify_chunk(chunk_fields, terrain_names, terrain, pin_distance, distance_bucket, clip_category, first_line_number):
+    mismatches = 0
+    for index, shot_fields in enumerate(chunk_fields):
+        shot_profile = classify_shot(shot_fields)
+        expected_pin_distance = shot_profile['pin_distance']
+        pin_matches = (np.isnan(pin_distance[index]) if expected_pin_distance is None
+                       else pin_distance[index] == expected_pin_distance)
+        if (terrain_names[terrain[index]] != shot_profile['terrain_type'] or not pin_matches or
+                distance_buckets[distance_bucket[index]] != distance_bucket_of(expected_pin_distance) or
+                clip_categories[clip_category[index]] != get_init_commentary_category(shot_profile)):
+            mismatches += 1
+            logging.error(f"Shot {first_line_number + index} differs: expected {shot_profile} "
+                          f"{get_init_commentary_category(shot_profile)}, got {terrain_names[terrain[index]]} "
+                          f"{distance_buckets[distance_bucket[index]]} {clip_categories[clip_category[index]]}")
+    return mismatches
+
+# Running totals per summary row, keyed by (terrain code, distance bucket code, clip category code)
+# with the terrain names of the analyze() call that built it
+class ShotSummary:
+    def __init__(self, terrain_names):
+        self.terrain_names = terrain_names
+        self.shots = {}
+        self.total_shot_time = {}
+
+    def add(self, terrain, distance_bucket, clip_category, shot_time):
+        # Rows are few, fold the chunk into them with one unique + bincount
+        keys = np.stack([terrain, distance_bucket, clip_category], axis=1)
+        unique_keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse, minlength=len(unique_keys))
+        shot_times = np.bincount(inverse, weights=shot_time, minlength=len(unique_keys))
+        for key, count, total in zip(map(tuple, unique_keys.tolist()), counts.tolist(), shot_times.tolist()):
+            self.shots[key] = self.shots.get(key, 0) + count
+            self.total_shot_time[key] = self.total_shot_time.get(key, 0.0) + total
+
+    def rows(self):
+        total = sum(self.shots.values())
+        for key, count in sorted(self.shots.items(), key=lambda item: -item[1]):
+            terrain, distance_bucket, clip_category = key
+            terrain_type = self.terrain_names[terrain]
+            yield {"outcome": terrain_type if terrain_type is not None else "none",
+                   "penalty": terrain in (WATER, DEFAULT),
+                   "distance_bucket": distance_buckets[distance_bucket],
+                   "clip_category": clip_categories[clip_category],
+                   "shots": count,
+                   "share": round(count / total, 4),
+                   "mean_shot_time": round(self.total_shot_time[key] / count, 3)}
+
+# Shot fields for each shot_data line, skipping anything else
+def read_shot_fields(shots_file, stats):
+    for line_number, line in enumerate(shots_file, start=1):
+        if line.strip() == "":
+            continue
+        try:
+            payload_type, payload_data = parse_message(line)
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            stats["malformed"] += 1
+            logging.debug(f"Skipping malformed line {line_number}: {e}")
+            continue
+        if payload_type != "shot_data":
+            stats["skipped"] += 1
+            continue
+        yield line_number, payload_data
+
+def analyze(shots_file, chunk_size=100000, verify=False):
+    terrain_names = list(known_terrain_names)
+    terrain_codes = {name: code for code, name in enumerate(terrain_names)}
+    summary = ShotSummary(terrain_names)
+    stats = {"shots": 0, "malformed": 0, "skipped": 0, "mismatches": 0}
+    columns = ShotColumns(chunk_size, terrain_names, terrain_codes)
+    chunk_fields = []
+    first_line_number = None
+
+    def flush():
+        terrain, pin_distance, distance_bucket, clip_category = classify_columns(columns)
+        summary.add(terrain, distance_bucket, clip_category, columns.shot_time[:columns.count])
+        if verify:
+            stats["mismatches"] += verify_chunk(chunk_fields, terrain_names, terrain, pin_distance, distance_bucket,
+                                                clip_category, first_line_number)
+        stats["shots"] += columns.count
+        columns.count = 0
+        chunk_fields.clear()
+
+    for line_number, shot_fields in read_shot_fields(shots_file, stats):
+        if columns.count == 0:
+            first_line_number = line_number
+        columns.append(shot_fields)
+        if verify:
+            chunk_fields.append(shot_fields)
+        if columns.count == chunk_size:
+            flush()
+    if columns.count > 0:
+        flush()
+    return summary, stats
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Summarise a JSONL file of shot_data messages")
+    parser.add_argument("shots", help="JSONL file with one shot_data message per line, - for stdin")
+    parser.add_argument("--output", help="CSV file for the summary, defaults to stdout")
+    parser.add_argument("--chunk-size", type=int, default=100000, help="shots held in memory at once")
+    parser.add_argument("--verify", action="store_true", help="check every shot against get_shot_profile")
+    args = parser.parse_args(argv)
+
+    shots_file = sys.stdin if args.shots == "-" else open(args.shots, encoding='utf-8')
+    try:
+        summary, stats = analyze(shots_file, chunk_size=args.chunk_size, verify=args.verify)
+    finally:
+        if shots_file is not sys.stdin:
+            shots_file.close()
+
+    output = sys.stdout if args.output is None else open(args.output, 'w', newline='')
+    try:
+        writer = csv.DictWriter(output, fieldnames=["outcome", "penalty", "distance_bucket", "clip_category",
+                                                    "shots", "share", "mean_shot_time"])
+        writer.writeheader()
+        writer.writerows(summary.rows())
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    logging.info(json.dumps(stats))
+    if args.verify:
+        if stats["mismatches"] > 0:
+            logging.error(f"{stats['mismatches']} shots differ from get_shot_profile")
+            return 1
+        logging.info(f"All {stats['shots']} shots match get_shot_profile")
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,112 @@
+import numpy as np
+from shot_profile import format_distance_to_pin
+
+# Shot history for the player at a bay so the end commentary can refer back to earlier shots.
+# The last capacity shot profiles are kept as codes and floats in fixed size arrays used as a
+# ring buffer, and running aggregates over every shot are updated as each one is added, so the
+# memory per player is fixed and a summary never has to scan the history
+
+# Terrain and shot shape codes, anything not listed is kept as OTHER. The terrain types are the ones
+# classify_shot hands on, it has already turned dirt, deep grass and wood into None
+OTHER = -1
+terrain_types = (None, "default", "green", "tee_box", "water", "bunker", "hole in one")
+shot_shapes = ("straight", "draw", "fade", "hook", "slice")
+terrain_codes = {terrain_type: code for code, terrain_type in enumerate(terrain_types)}
+shot_shape_codes = {shot_shape: code for code, shot_shape in enumerate(shot_shapes)}
+
+# Where a shot finished as said in the summary
+terrain_descriptions = {"default": "out of bounds", "green": "on the green", "tee_box": "on the tee box",
+                        "water": "in the water", "bunker": "in a bunker", "hole in one": "in the hole"}
+
+class ShotHistory:
+    def __init__(self, capacity=16):
+        self.capacity = capacity
+        self.terrain = np.zeros(capacity, dtype=np.int8)
+        self.pin_distance = np.zeros(capacity, dtype=np.float32)
+        self.shot_shape = np.zeros(capacity, dtype=np.int8)
+        self.shot_time = np.zeros(capacity, dtype=np.float32)
+        self.x = np.zeros(capacity, dtype=np.float32)
+        self.y = np.zeros(capacity, dtype=np.float32)
+        self.clear()
+
+    def clear(self):
+        # Shots added since the last clear, only the last capacity of them are still in the arrays
+        self.count = 0
+        self.best_pin_distance = None
+        self.water = 0
+        self.out_of_bounds = 0
+        self.greens = 0
+        self.bunkers = 0
+        self.holes_in_one = 0
+
+    def add(self, shot_profile):
+        """ Record a classified shot profile """
+        index = self.count % self.capacity
+        terrain_type = shot_profile['terrain_type']
+        pin_distance = shot_profile['pin_distance']
+        self.terrain[index] = terrain_codes.get(terrain_type, OTHER)
+        # No distance for water, out of bounds and holes in one
+        self.pin_distance[index] = np.nan if pin_distance is None else pin_distance
+        self.shot_shape[index] = shot_shape_codes.get(shot_profile['shot_shape'], OTHER)
+        self.shot_time[index] = shot_profile['shot_time']
+        self.x[index] = shot_profile['x']
+        self.y[index] = shot_profile['y']
+        self.count += 1
+
+        if pin_distance is not None and (self.best_pin_distance is None or pin_distance < self.best_pin_distance):
+            self.best_pin_distance = pin_distance
+        if terrain_type == "water":
+            self.water += 1
+        elif terrain_type == "default":
+            self.out_of_bounds += 1
+        elif terrain_type == "green":
+            self.greens += 1
+        elif terrain_type == "bunker":
+            self.bunkers += 1
+        elif terrain_type == "hole in one":
+            self.holes_in_one += 1
+
+    def shot_number(self):
+        """ Number of the next shot """
+        return self.count + 1
+
+    def recent(self, back=0):
+        """ The shot back shots before the latest one as a dict, None once it has left the buffer """
+        if back >= min(self.count, self.capacity):
+            return None
+        index = (self.count - 1 - back) % self.capacity
+        terrain = int(self.terrain[index])
+        shot_shape = int(self.shot_shape[index])
+        pin_distance = float(self.pin_distance[index])
+        return {'terrain_type': terrain_types[terrain] if terrain != OTHER else "other",
+                'pin_distance': None if np.isnan(pin_distance) else pin_distance,
+                'shot_shape': shot_shapes[shot_shape] if shot_shape != OTHER else "other",
+                'shot_time': float(self.shot_time[index]),
+                'x': float(self.x[index]),
+                'y': float(self.y[index])}
+
+    def summary(self, recent_shots=3):
+        """ Short description of the shots so far for the commentary prompt, None before the first shot """
+        if self.count == 0:
+            return None
+        descriptions = []
+        for back in range(recent_shots):
+            shot = self.recent(back)
+            if shot is None:
+                break
+            description = shot['shot_shape'] if shot['shot_shape'] != "other" else "shot"
+            if shot['terrain_type'] in terrain_descriptions:
+                description += " " + terrain_descriptions[shot['terrain_type']]
+            if shot['pin_distance'] is not None:
+                description += ", " + format_distance_to_pin(shot['pin_distance']).lower() + " from the pin"
+            descriptions.append(description)
+        summary = [f"{self.count} earlier shot{'s' if self.count != 1 else ''}",
+                   "most recent first: " + "; ".join(descriptions)]
+        if self.best_pin_distance is not None:
+            summary.append("closest to the pin: " + format_distance_to_pin(self.best_pin_distance).lower())
+        for count, what in ((self.holes_in_one, "in the hole"), (self.greens, "on the green"),
+                            (self.bunkers, "in a bunker"), (self.water, "in the water"), (self.out_of_bounds, "out of bounds")):
+            if count > 0:
+                summary.append(f"{count} {what}")
+        return ". ".join(summary)
+
@@ -0,0 +1,116 @@
+import json
+import threading
+
+# Shot profile extraction from the simulator's shot_data messages.
+#
+# shot_data carries the full trajectory (segments[].points[] and snapshots[]) but the commentary
+# only needs a handful of fields. When pysimdjson is installed messages are parsed lazily and only
+# the fields that are read become Python objects, otherwise they are parsed with json.loads
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# simdjson parsers aren't thread safe, each websocket thread gets its own
+thread_parsers = threading.local()
+
+# The fields shot classification needs from a parsed shot_data message. Works on dicts
+# and on lazy simdjson documents, which don't support negative indexes
+def extract_shot_fields(payload_data):
+    data = payload_data['shot_complete']['data']
+    segments = data['segments']
+    points = segments[len(segments) - 1]['points']
+    snapshots = data['snapshots']
+    final_snapshot = snapshots[len(snapshots) - 1]
+    position_on_course = final_snapshot['position_on_course']
+    return {
+        'shot_shape': data['shot_shape'],
+        'shot_time': points[len(points) - 1]['time'],
+        'terrain_type': final_snapshot['terrain_type'],
+        'pin_distance': final_snapshot['pin_distance'],
+        'y': position_on_course['y'],
+        'x': position_on_course['x'],
+        'final_resting_state': data['final_resting_state']
+    }
+
+# Shot profile used to pick the commentary from the extracted shot fields
+def classify_shot(shot_fields):
+    shot_profile = {}
+    shot_profile['shot_shape'] = shot_fields['shot_shape']
+    shot_profile['shot_time'] = shot_fields['shot_time']
+    shot_profile['terrain_type'] = shot_fields['terrain_type']
+    shot_profile['pin_distance'] = shot_fields['pin_distance']
+    shot_profile['y'] = shot_fields['y']
+    shot_profile['x'] = shot_fields['x']
+    if shot_profile['y'] < -69900 and shot_profile['x'] > -21361 and shot_profile['terrain_type'] == "default":
+        shot_profile['terrain_type'] = None
+    if shot_profile['terrain_type'] == "dirt" or shot_profile["terrain_type"] == "deep_grass" or shot_profile["terrain_type"] == "wood":
+        shot_profile['terrain_type'] = None
+    if shot_profile['terrain_type'] == "green" and shot_profile["pin_distance"] >= 2743.19995:
+        shot_profile['terrain_type'] = None
+    if shot_profile['shot_time'] > 5 and shot_profile["terrain_type"] == "tee_box":
+        shot_profile["terrain_type"] = None
+    shot_profile['final_resting_state'] = shot_fields['final_resting_state']
+    if shot_profile['final_resting_state'] == "hole":
+        shot_profile['terrain_type'] = "hole in one"
+    if shot_profile['terrain_type'] == "hole in one" or shot_profile['terrain_type'] == "water" or shot_profile['terrain_type'] == "default":
+        shot_profile['pin_distance'] = None
+
+    return shot_profile
+
+# Get shot profile from a parsed shot_data message
+def get_shot_profile(payload_data):
+    return classify_shot(extract_shot_fields(payload_data))
+
+# Returns init commentary clip category based on shot profile
+def get_init_commentary_category(shot_profile):
+    if shot_profile['terrain_type'] == "green" or shot_profile['terrain_type'] == "hole in one":
+        return "good"
+    elif shot_profile['terrain_type'] == "tee_box":
+        return "tee_box"
+    elif shot_profile['terrain_type'] == "water" or shot_profile['terrain_type'] == "default":
+        return "water_default"
+    elif shot_profile['shot_time'] < 5.5 and shot_profile['pin_distance'] >= 2743.19:
+        return "short"
+    return "average"
+
+# Format the distance to pin for a shot in cm
+# If greater than 2743.19995 cm format as yards
+# else format as feet
+
+def format_distance_to_pin(pin_distance: float) -> str:
+    if pin_distance == None:
+        return pin_distance
+    if pin_distance >= 2743.19995:
+        pin_distance_yards = f"{round(pin_distance/91.44)}"
+        return "Just about " + pin_distance_yards + " yards"
+    else:
+        pin_distance_feet = f"{round(pin_distance/30.48)}"
+        return "Just about " + pin_distance_feet + " feet"
+
+def get_thread_parser():
+    parser = getattr(thread_parsers, "parser", None)
+    if parser is None:
+        parser = simdjson.Parser()
+        thread_parsers.parser = parser
+    return parser
+
+# Parse a /watsonx message into (message type, payload). shot_data payloads come back as just
+# the fields classify_shot needs, everything else as a dict
+def parse_message(payload_raw):
+    if simdjson is None:
+        payload_data = json.loads(payload_raw)
+        if payload_data["type"] == "shot_data":
+            return "shot_data", extract_shot_fields(payload_data)
+        return payload_data["type"], payload_data
+    try:
+        document = get_thread_parser().parse(payload_raw)
+    except RuntimeError:
+        # Something still holds a document from this thread's parser, e.g. an exception traceback
+        thread_parsers.parser = simdjson.Parser()
+        document = thread_parsers.parser.parse(payload_raw)
+    # Nothing from the document can outlive this call or the parser can't be reused
+    payload_type = document["type"]
+    if payload_type == "shot_data":
+        return payload_type, extract_shot_fields(document)
+    return payload_type, document.as_dict()
@@ -0,0 +1,30 @@
+import requests
+
+# Stand-in for ibm_watson_machine_learning's Model that talks to the benchmark LLM stub
+# (bench/stub_servers.py) so load tests never hit watsonx.ai. Same generate_text and
+# generate_text_stream calls as Model
+class StubModel:
+    def __init__(self, url, params=None):
+        self.url = url.rstrip('/')
+        self.params = params or {}
+        self.session = requests.Session()
+
+    def generate_text(self, prompt, params=None):
+        """ Generated text for a prompt """
+        response = self.session.post(f"{self.url}/generate",
+                                     json={"prompt": prompt, "params": params or self.params})
+        response.raise_for_status()
+        return response.json()["generated_text"]
+
+    def generate_text_stream(self, prompt, params=None):
+        """ Yield the generated text in chunks as the stub produces them """
+        response = self.session.post(f"{self.url}/generate_stream",
+                                     json={"prompt": prompt, "params": params or self.params},
+                                     stream=True)
+        try:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
+                if chunk:
+                    yield chunk
+        finally:
+            response.close()
@@ -0,0 +1,58 @@
+import io
+import json
+import numpy as np
+import pytest
+from shot_analytics import analyze, known_terrain_names
+
+# Shots sitting exactly on, and just either side of, every classification threshold
+
+def shot_message(terrain_type, pin_distance, shot_time, x=0.0, y=0.0, final_resting_state="stopped"):
+    return json.dumps({"type": "shot_data",
+                       "shot_complete": {"data": {
+                           "shot_shape": "straight",
+                           "final_resting_state": final_resting_state,
+                           "segments": [{"points": [{"time": shot_time}]}],
+                           "snapshots": [{"terrain_type": terrain_type,
+                                          "pin_distance": pin_distance,
+                                          "position_on_course": {"x": x, "y": y}}]}}})
+
+def around(value):
+    return (float(np.nextafter(value, -np.inf)), value, float(np.nextafter(value, np.inf)))
+
+def threshold_shots():
+    shots = []
+    # Out of bounds ignored past the y/x corner
+    for y in around(-69900.0):
+        for x in around(-21361.0):
+            shots.append(shot_message("default", 5000.0, 6.0, x=x, y=y))
+    # Green only counts inside the yards cutoff, and the distance unit switches there
+    for pin_distance in around(2743.19995):
+        shots.append(shot_message("green", pin_distance, 6.0))
+        shots.append(shot_message("dirt", pin_distance, 6.0))
+    # Tee box only counts for quick shots
+    for shot_time in around(5.0):
+        shots.append(shot_message("tee_box", 100.0, shot_time))
+    # Short clip needs a quick shot at least 2743.19 from the pin
+    for shot_time in around(5.5):
+        for pin_distance in around(2743.19):
+            shots.append(shot_message("deep_grass", pin_distance, shot_time))
+    shots.append(shot_message("water", 2743.19, 5.0))
+    shots.append(shot_message("green", 2743.19995, 5.0, final_resting_state="hole"))
+    return shots
+
+@pytest.mark.parametrize("chunk_size", [100000, 4])
+def test_thresholds_match_per_shot_classification(chunk_size):
+    shots = threshold_shots()
+    summary, stats = analyze(io.StringIO("\n".join(shots) + "\n"), chunk_size=chunk_size, verify=True)
+    assert stats["mismatches"] == 0
+    assert stats["shots"] == len(shots)
+    assert sum(row["shots"] for row in summary.rows()) == len(shots)
+
+def test_unknown_terrains_are_coded_per_call():
+    first, _ = analyze(io.StringIO(shot_message("bunker", 100.0, 6.0) + "\n"), verify=True)
+    second, stats = analyze(io.StringIO(shot_message("fairway", 100.0, 6.0) + "\n" +
+                                        shot_message("bunker", 100.0, 6.0) + "\n"), verify=True)
+    assert stats["mismatches"] == 0
+    assert [row["outcome"] for row in first.rows()] == ["bunker"]
+    assert sorted(row["outcome"] for row in second.rows()) == ["bunker", "fairway"]
+    assert "bunker" not in known_terrain_names
@@ -0,0 +1,224 @@
+import os
+import hashlib
+import logging
+import threading
+import collections
+from ibm_watson.websocket import SynthesizeCallback
+
+# Content addressed cache for synthesized TTS audio.
+# Audio is keyed by a hash of (text, voice, customization id, accept) and kept in an in memory
+# LRU tier over an on disk tier, both evicted by size. Hits are streamed through the caller's
+# callback exactly like a live synthesis and concurrent requests for the same key share one
+# in flight synthesis, followers get the audio as it arrives.
+#
+# The disk tier can be shared by several processes, each one evicts based on what it has seen
+# so the total size on disk is approximate
+
+# Newer websocket-client versions report the TTS service closing the connection
+# normally through on_error, that isn't a failed synthesis
+def is_normal_close(error):
+    return getattr(error, "status_code", None) == 1000
+
+# Stream audio through a TTS callback as if it was a live synthesis
+def replay_audio(chunks, synthesize_callback):
+    synthesize_callback.on_connected()
+    for chunk in chunks:
+        synthesize_callback.on_audio_stream(chunk)
+    synthesize_callback.on_close()
+
+# Synthesis in progress that other requests for the same key can follow
+class InFlightSynthesis:
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def add(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, failed):
+        with self.condition:
+            self.done = True
+            self.failed = failed
+            self.condition.notify_all()
+
+    def follow(self, synthesize_callback):
+        """ Forward chunks to the callback as they arrive, False if the synthesis failed before any audio """
+        forwarded = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: len(self.chunks) > forwarded or self.done)
+                chunks = self.chunks[forwarded:]
+                done = self.done
+                failed = self.failed
+            if forwarded == 0 and len(chunks) == 0 and failed:
+                return False
+            if forwarded == 0 and len(chunks) > 0:
+                synthesize_callback.on_connected()
+            for chunk in chunks:
+                synthesize_callback.on_audio_stream(chunk)
+            forwarded += len(chunks)
+            if done and forwarded == len(self.chunks):
+                if forwarded > 0:
+                    synthesize_callback.on_close()
+                return True
+
+# Passes a live synthesis through to the caller's callback while recording it
+class RecordingSynthesizeCallback(SynthesizeCallback):
+    def __init__(self, synthesize_callback, in_flight):
+        SynthesizeCallback.__init__(self)
+        self.synthesize_callback = synthesize_callback
+        self.in_flight = in_flight
+        self.failed = False
+
+    def on_connected(self):
+        self.synthesize_callback.on_connected()
+
+    def on_error(self, error):
+        if not is_normal_close(error):
+            self.failed = True
+        self.synthesize_callback.on_error(error)
+
+    def on_timing_information(self, timing_information):
+        self.synthesize_callback.on_timing_information(timing_information)
+
+    def on_audio_stream(self, audio_stream):
+        self.in_flight.add(audio_stream)
+        self.synthesize_callback.on_audio_stream(audio_stream)
+
+    def on_close(self):
+        self.synthesize_callback.on_close()
+
+class TTSCache:
+    def __init__(self, cache_dir, memory_max_bytes=32 * 1024 * 1024, disk_max_bytes=512 * 1024 * 1024, chunk_size=8192):
+        self.cache_dir = cache_dir
+        self.memory_max_bytes = memory_max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self.chunk_size = chunk_size
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.disk_size = sum(size for path, size, mtime in self._disk_entries())
+
+    @staticmethod
+    def key(text, voice, customization_id, accept):
+        key_parts = '\0'.join(str(part) for part in (text, voice, customization_id, accept))
+        return hashlib.sha256(key_parts.encode('utf-8')).hexdigest()
+
+    def synthesize(self, tts_service, text, synthesize_callback, voice=None, customization_id=None, accept='audio/wav'):
+        """ Same as tts_service.synthesize_using_websocket but served from the cache when possible """
+        key = self.key(text, voice, customization_id, accept)
+        audio = self.get(key)
+        if audio is not None:
+            logging.debug(f"TTS cache hit for {key}")
+            replay_audio(self._chunks(audio), synthesize_callback)
+            return
+        with self.lock:
+            in_flight = self.in_flight.get(key)
+            leader = in_flight is None
+            if leader:
+                in_flight = InFlightSynthesis()
+                self.in_flight[key] = in_flight
+        if not leader:
+            logging.debug(f"TTS cache following in flight synthesis for {key}")
+            if in_flight.follow(synthesize_callback):
+                return
+            # The synthesis we were following failed, try on our own
+            tts_service.synthesize_using_websocket(text, synthesize_callback, customization_id=customization_id,
+                                                   accept=accept, voice=voice)
+            return
+        recording_callback = RecordingSynthesizeCallback(synthesize_callback, in_flight)
+        failed = True
+        try:
+            tts_service.synthesize_using_websocket(text, recording_callback, customization_id=customization_id,
+                                                   accept=accept, voice=voice)
+            failed = recording_callback.failed or len(in_flight.chunks) == 0
+            if not failed:
+                try:
+                    self.put(key, b''.join(in_flight.chunks))
+                except OSError as e:
+                    logging.error(f"Unable to cache synthesized audio for {key}: {e}")
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            in_flight.finish(failed)
+
+    def get(self, key):
+        with self.lock:
+            audio = self.memory.get(key)
+            if audio is not None:
+                self.memory.move_to_end(key)
+                return audio
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cached:
+                audio = cached.read()
+            # Mark as recently used for disk eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        self._put_memory(key, audio)
+        return audio
+
+    def put(self, key, audio):
+        self._put_memory(key, audio)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, 'wb') as cached:
+            cached.write(audio)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.disk_size += len(audio)
+            over_size = self.disk_size > self.disk_max_bytes
+        if over_size:
+            self._evict_disk()
+
+    def _put_memory(self, key, audio):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                return
+            self.memory[key] = audio
+            self.memory_size += len(audio)
+            while self.memory_size > self.memory_max_bytes and len(self.memory) > 0:
+                evicted_key, evicted_audio = self.memory.popitem(last=False)
+                self.memory_size -= len(evicted_audio)
+
+    def _evict_disk(self):
+        # Least recently used files go first until the tier is back to 90% of its cap
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[2])
+        disk_size = sum(size for path, size, mtime in entries)
+        for path, size, mtime in entries:
+            if disk_size <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                disk_size -= size
+            except FileNotFoundError:
+                pass
+        with self.lock:
+            self.disk_size = disk_size
+
+    def _disk_entries(self):
+        for prefix in os.scandir(self.cache_dir):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith('.audio'):
+                    try:
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+                    except FileNotFoundError:
+                        pass
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.audio')
+
+    def _chunks(self, audio):
+        return [audio[offset:offset + self.chunk_size] for offset in range(0, len(audio), self.chunk_size)]
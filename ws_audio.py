@@ -0,0 +1,127 @@
+import json
+import queue
+import struct
+import logging
+import threading
+import itertools
+import time
+from audio_engine import SAMPLE_RATE, CHANNELS, PRIORITY_CLIP
+
+# Sends audio to the simulator over its websocket instead of the local speakers.
+#
+# Each sound is a stream. A text frame announces it:
+# {"type": "audio_start", "stream": id, "kind": "intro|clip|commentary", "priority": n,
+#  "crossfade": secs, "sample_rate": 22050, "channels": 1, "format": "s16le"}
+# then its PCM goes out as binary frames, each with a 19 byte little endian header:
+#   magic     2 bytes  b'AU'
+#   flags     uint8    bit 0 set on the last frame of the stream
+#   stream    uint32   stream id
+#   sequence  uint32   frame number within the stream, gaps mean frames were dropped
+#   timestamp uint64   server wall clock in ms when the frame was queued
+#
+# Frames are queued and sent by one sender thread per connection. When the client can't keep up
+# and the queue stays full for send_timeout secs the frame is dropped rather than stalling the server
+
+FRAME_MAGIC = b'AU'
+FRAME_HEADER = struct.Struct('<2sBIIQ')
+FLAG_LAST_FRAME = 1
+
+# Websocket wrapper that lets several threads send on one connection
+class SerializedWebSocket:
+    def __init__(self, ws):
+        self.ws = ws
+        self.send_lock = threading.Lock()
+
+    def send(self, data):
+        with self.send_lock:
+            self.ws.send(data)
+
+    def receive(self, timeout=None):
+        return self.ws.receive(timeout)
+
+# Handle for a stream being sent, wait() returns once all of it has been queued
+class StreamPlayback:
+    def __init__(self, stream_id, source):
+        self.stream_id = stream_id
+        self.source = source
+        self.done = threading.Event()
+        self.stopped = False
+
+    def stop(self, fade_out=0.0):
+        self.stopped = True
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+# Audio output for one websocket connection, same play() interface as AudioEngine
+class WebSocketAudioSink:
+    def __init__(self, ws, max_queued_frames=256, frame_samples=2048, send_timeout=0.05):
+        self.ws = ws
+        self.frame_samples = frame_samples
+        self.send_timeout = send_timeout
+        self.frames = queue.Queue(max_queued_frames)
+        self.stream_ids = itertools.count(1)
+        self.dropped_frames = 0
+        self.closed = False
+        self.sender = threading.Thread(target=self._send_frames, daemon=True)
+        self.sender.start()
+
+    def play(self, source, priority=PRIORITY_CLIP, crossfade=0.0, kind=None):
+        """ Start streaming a source to the client """
+        playback = StreamPlayback(next(self.stream_ids), source)
+        self._queue(json.dumps({"type": "audio_start",
+                                "stream": playback.stream_id,
+                                "kind": kind,
+                                "priority": priority,
+                                "crossfade": crossfade,
+                                "sample_rate": SAMPLE_RATE,
+                                "channels": CHANNELS,
+                                "format": "s16le"}), drop=False)
+        threading.Thread(target=self._pump, args=(playback,), daemon=True).start()
+        return playback
+
+    def close(self):
+        self.closed = True
+        try:
+            self.frames.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _pump(self, playback):
+        # Send the source as fast as it produces audio, the client buffers and plays it
+        sequence = 0
+        source = playback.source
+        while not self.closed and not playback.stopped:
+            source.wait_readable(timeout=1.0)
+            samples = source.read(self.frame_samples)
+            last = source.finished()
+            if len(samples) > 0 or last:
+                header = FRAME_HEADER.pack(FRAME_MAGIC, FLAG_LAST_FRAME if last else 0, playback.stream_id,
+                                           sequence, int(time.time() * 1000))
+                self._queue(header + samples.tobytes(), drop=not last)
+                sequence += 1
+            if last:
+                break
+        playback.done.set()
+
+    def _queue(self, frame, drop=True):
+        if self.closed:
+            return
+        try:
+            # Stream announcements and last frames are worth waiting a little longer for
+            self.frames.put(frame, timeout=self.send_timeout if drop else max(1.0, self.send_timeout))
+        except queue.Full:
+            self.dropped_frames += 1
+            logging.warning(f"Websocket audio client too slow - dropped {self.dropped_frames} frames so far")
+
+    def _send_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                return
+            try:
+                self.ws.send(frame)
+            except Exception as e:
+                logging.debug(f"Websocket audio sender stopping: {e}")
+                self.closed = True
+                return